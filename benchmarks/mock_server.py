@@ -0,0 +1,228 @@
+import json
+import posixpath
+import random
+import time
+from collections import Counter
+from hashlib import md5
+from itertools import count
+from threading import Lock, Thread
+
+from flask import Flask, Response, request
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+BLOCK_SIZE = 4 << 20
+CHUNK_SIZE = 64 << 10
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'  # so connections are reused like they are with Baidu
+
+    def log_request(self, *args):
+        pass
+
+
+class MockPan:
+    # a stand-in for the xpan and pcs APIs of Baidu Pan, backed by a dict in memory.
+    # latency is added to every request, bandwidth (bytes/s) limits every connection, a fraction of requests
+    # fail with error_rate (HTTP 500) and throttle_rate (errno 31034).
+    def __init__(self, latency=0.0, bandwidth=0, error_rate=0.0, throttle_rate=0.0, seed=0):
+        self.latency, self.bandwidth = latency, bandwidth
+        self.error_rate, self.throttle_rate = error_rate, throttle_rate
+        self.random = random.Random(seed)
+        self.lock = Lock()
+        self.fs = {'/': None}  # path: bytes, None for directories
+        self.mtime = {'/': int(time.time())}
+        self.md5s = {}  # content md5: bytes, for rapid upload
+        self.parts = {}  # (uploadid, partseq): bytes
+        self.uploadids = count(1)
+        self.calls, self.bytes = Counter(), Counter()
+        self.app = self._app()
+        self.server = None
+
+    def put(self, path, data=None, mtime=1600000000):
+        with self.lock:
+            parent = posixpath.dirname(path)
+            while parent not in self.fs:
+                self.fs[parent], self.mtime[parent] = None, mtime
+                parent = posixpath.dirname(parent)
+            self.fs[path], self.mtime[path] = data, mtime
+            if data is not None:
+                self.md5s[md5(data).hexdigest()] = data
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls.clear()
+            self.bytes.clear()
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = make_server(host, port, self.app, threaded=True, request_handler=KeepAliveHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://{host}:{self.server.server_port}'
+
+    def stop(self):
+        self.server.shutdown()
+
+    def urls(self, base):
+        return {'PCS': base + '/rest/2.0/pcs/', 'XPAN': base + '/rest/2.0/xpan/', 'SHARE': base + '/share/'}
+
+    def meta(self, path):
+        data = self.fs[path]
+        return {'path': path, 'server_filename': posixpath.basename(path), 'isdir': int(data is None),
+                'size': len(data or b''), 'local_mtime': self.mtime[path], 'local_ctime': self.mtime[path],
+                'server_mtime': self.mtime[path], 'server_ctime': self.mtime[path], 'fs_id': abs(hash(path)),
+                'md5': md5(data).hexdigest() if data is not None else '', 'category': 6}
+
+    def _children(self, path):
+        return sorted(x for x in self.fs if x != '/' and posixpath.dirname(x) == path)
+
+    def _throttle(self, n):
+        if self.bandwidth:
+            time.sleep(n / self.bandwidth)
+
+    def _app(self):
+        app = Flask(__name__)
+
+        def handler(api):
+            def handle(path):
+                method = request.args.get('method', '')
+                with self.lock:
+                    self.calls[f'{api} {method}'] += 1
+                    injected = self.random.random()
+                if self.latency:
+                    time.sleep(self.latency)
+                if injected < self.error_rate:
+                    return Response('internal error', 500)
+                if injected < self.error_rate + self.throttle_rate:
+                    return error(api, 31034, 400)
+                func = getattr(self, f'_{api}_{method}', None)
+                return func() if func is not None else error(api, 3, 400)
+            handle.__name__ = f'handle_{api}'
+            return handle
+
+        def error(api, errno, status):
+            if api == 'pcs':
+                return Response(json.dumps({'error_code': errno}), status, mimetype='application/json')
+            return {'errno': errno}
+
+        for api in ('xpan', 'pcs', 'share'):
+            prefix = '/share' if api == 'share' else f'/rest/2.0/{api}'
+            app.add_url_rule(prefix + '/<path>', view_func=handler(api), methods=['GET', 'POST'])
+        return app
+
+    def _xpan_list(self):
+        path = request.args['dir'].rstrip('/') or '/'
+        start, limit = int(request.args.get('start', 0)), int(request.args.get('limit', 1000))
+        with self.lock:
+            if self.fs.get(path, b'') is not None:
+                return {'errno': -9}
+            return {'errno': 0, 'list': [self.meta(x) for x in self._children(path)[start:start + limit]]}
+
+    def _xpan_listall(self):
+        path = request.args['path'].rstrip('/') or '/'
+        start, limit = int(request.args.get('start', 0)), int(request.args.get('limit', 1000))
+        with self.lock:
+            if self.fs.get(path, b'') is not None:
+                return {'errno': -9}
+            prefix = path.rstrip('/') + '/'
+            found = sorted(x for x in self.fs if x.startswith(prefix))
+            return {'errno': 0, 'list': [self.meta(x) for x in found[start:start + limit]],
+                    'has_more': int(start + limit < len(found)), 'cursor': start + limit}
+
+    def _xpan_search(self):
+        path, key = request.args['dir'].rstrip('/') or '/', request.args['key']
+        with self.lock:
+            return {'errno': 0, 'list': [self.meta(x) for x in self._children(path)
+                                         if key in posixpath.basename(x)]}
+
+    def _xpan_precreate(self):
+        form = request.form
+        data = self.md5s.get(form.get('content-md5'))
+        if data is not None and len(data) == int(form['size']):  # rapid upload
+            self.put(form['path'], data, int(form['local_mtime']))
+            with self.lock:
+                return {'errno': 0, 'return_type': 2, 'info': self.meta(form['path'])}
+        return {'errno': 0, 'return_type': 1, 'uploadid': str(next(self.uploadids)),
+                'block_list': list(range(len(json.loads(form['block_list']))))}
+
+    def _xpan_create(self):
+        form = request.form
+        path = form['path'].rstrip('/') or '/'
+        if form['isdir'] == '1':
+            if path in self.fs:
+                return {'errno': -8}
+            self.put(path, None, int(time.time()))
+        else:
+            uploadid = form['uploadid']
+            with self.lock:
+                seqs = sorted(k[1] for k in self.parts if k[0] == uploadid)
+                data = b''.join(self.parts.pop((uploadid, i)) for i in seqs)
+            if len(data) != int(form['size']):
+                return {'errno': 31363}  # block miss in superfile2
+            self.put(path, data, int(form['local_mtime']))
+        with self.lock:
+            meta = self.meta(path)
+        return dict(meta, errno=0, ctime=meta['server_ctime'], mtime=meta['server_mtime'])
+
+    def _xpan_filemanager(self):
+        opera, filelist = request.args['opera'], json.loads(request.form['filelist'])
+        info = []
+        with self.lock:
+            for x in filelist:
+                src = (x if isinstance(x, str) else x['path']).rstrip('/')
+                moved = [k for k in self.fs if k == src or k.startswith(src + '/')]
+                if not moved:
+                    info.append({'errno': -9, 'path': src})
+                    continue
+                for k in moved:
+                    data, mtime = self.fs[k], self.mtime[k]
+                    if opera != 'copy':
+                        del self.fs[k], self.mtime[k]
+                    if opera != 'delete':
+                        dst = posixpath.join(x.get('dest', posixpath.dirname(src)), x['newname']) + k[len(src):]
+                        self.fs[dst], self.mtime[dst] = data, mtime
+                info.append({'errno': 0, 'path': src})
+        if request.args.get('async') == '2':
+            return {'errno': 0, 'taskid': 1}
+        return {'errno': 0, 'info': info}
+
+    def _share_taskquery(self):
+        return {'errno': 0, 'status': 'success'}
+
+    def _pcs_download(self):
+        with self.lock:
+            data = self.fs.get(request.args['path'])
+        if data is None:
+            return Response(json.dumps({'error_code': 31066}), 404, mimetype='application/json')
+        start, end, status = 0, len(data), 200
+        if 'Range' in request.headers:
+            first, last = request.headers['Range'][len('bytes='):].split('-')
+            start, end, status = int(first), min(int(last) + 1 if last else len(data), len(data)), 206
+
+        def stream():
+            for i in range(start, end, CHUNK_SIZE):
+                chunk = data[i:min(i + CHUNK_SIZE, end)]
+                self._throttle(len(chunk))
+                with self.lock:
+                    self.bytes['download'] += len(chunk)
+                yield chunk
+        headers = {'Content-Length': str(end - start)}
+        if status == 206:
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{len(data)}'
+        return Response(stream(), status, headers=headers, mimetype='application/octet-stream')
+
+    def _pcs_meta(self):
+        with self.lock:
+            data = self.fs.get(request.args['path'])
+        if data is None:
+            return Response(json.dumps({'error_code': 31066}), 404, mimetype='application/json')
+        blocks = [md5(data[i:i + BLOCK_SIZE]).hexdigest() for i in range(0, max(len(data), 1), BLOCK_SIZE)]
+        with self.lock:
+            return {'list': [dict(self.meta(request.args['path']), block_list=json.dumps(blocks))]}
+
+    def _pcs_upload(self):
+        data = request.files['file'].read()
+        self._throttle(len(data))
+        with self.lock:
+            self.parts[(request.args['uploadid'], int(request.args['partseq']))] = data
+            self.bytes['upload'] += len(data)
+        return {'md5': md5(data).hexdigest()}
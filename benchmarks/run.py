@@ -0,0 +1,219 @@
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from pyBaiduPan import BdPan  # noqa: E402
+from pyBaiduPan.config import DEFAULT_CONFIG  # noqa: E402
+from mock_server import MockPan  # noqa: E402
+
+SCENARIOS = {}
+
+
+def scenario(func):
+    SCENARIOS[func.__name__] = func
+    return func
+
+
+def randbytes(rand, n):  # random.randbytes needs python 3.9
+    return rand.getrandbits(n * 8).to_bytes(n, 'little')
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+# every scenario prepares the server and local files, then returns a function doing the measured work,
+# the number of files and bytes it transfers, and the remote directory that must equal the local one after it.
+@scenario
+def small_files_upload(server, pan, tmp, scale, rand):
+    n = 200 * scale
+    for i in range(n):
+        write(os.path.join(tmp, f'd{i % 10}', f'f{i}'), randbytes(rand, 4 << 10))
+    return lambda: pan.upload(tmp, '/small'), n, n * (4 << 10), '/small'
+
+
+@scenario
+def small_files_download(server, pan, tmp, scale, rand):
+    n = 200 * scale
+    for i in range(n):
+        server.put(f'/small/d{i % 10}/f{i}', randbytes(rand, 4 << 10))
+    return lambda: pan.download('/small', tmp), n, n * (4 << 10), '/small'
+
+
+@scenario
+def huge_files_upload(server, pan, tmp, scale, rand):
+    size = (32 << 20) * scale
+    for i in range(2):
+        write(os.path.join(tmp, f'huge{i}'), randbytes(rand, size))
+    return lambda: pan.upload(tmp, '/huge'), 2, 2 * size, '/huge'
+
+
+@scenario
+def huge_files_download(server, pan, tmp, scale, rand):
+    size = (32 << 20) * scale
+    for i in range(2):
+        server.put(f'/huge/huge{i}', randbytes(rand, size))
+    return lambda: pan.download('/huge', tmp), 2, 2 * size, '/huge'
+
+
+def deep_tree(server, path, depth, rand):
+    # a binary tree of directories with a small file in each of them, return the number of files
+    server.put(path + '/f', randbytes(rand, 1 << 10))
+    if depth == 0:
+        return 1
+    return 1 + deep_tree(server, path + '/d0', depth - 1, rand) + deep_tree(server, path + '/d1', depth - 1, rand)
+
+
+@scenario
+def deep_tree_download(server, pan, tmp, scale, rand):
+    n = deep_tree(server, '/deep', 6 + scale, rand)
+    return lambda: pan.download('/deep', tmp), n, n << 10, '/deep'
+
+
+@scenario
+def deep_tree_snapshot(server, pan, tmp, scale, rand):
+    n = deep_tree(server, '/deep', 6 + scale, rand)
+    pan.config['snapshot'] = True
+    return lambda: pan.download('/deep', tmp), n, n << 10, '/deep'
+
+
+@scenario
+def rapid_upload(server, pan, tmp, scale, rand):
+    n = 50 * scale
+    for i in range(n):
+        data = randbytes(rand, 256 << 10)
+        server.put(f'/known/f{i}', data)  # the server has the content already, under another path
+        write(os.path.join(tmp, f'f{i}'), data)
+    return lambda: pan.upload(tmp, '/rapid'), n, n * (256 << 10), '/rapid'
+
+
+def mismatches(server, remote_root, local_root):
+    # files that differ between the mock and the local tree, after the scenario is done.
+    remote = {k[len(remote_root) + 1:]: v for k, v in server.fs.items()
+              if k.startswith(remote_root + '/') and v is not None}
+    local = {}
+    for root, dirs, files in os.walk(local_root):
+        for x in files:
+            with open(os.path.join(root, x), 'rb') as f:
+                local[os.path.relpath(os.path.join(root, x), local_root).replace(os.sep, '/')] = f.read()
+    return sorted(k for k in set(remote) | set(local) if remote.get(k) != local.get(k))
+
+
+def new_pan(server, base, args):
+    config = dict(DEFAULT_CONFIG, hash_index='', meta_cache='', snapshot=False)
+    for key in ('segments', 'upload_workers', 'list_workers', 'transfer_workers', 'max_rate'):
+        if getattr(args, key):
+            config[key] = getattr(args, key)
+    pan = BdPan(config)
+    del pan.logger.handlers[:-1]  # every BdPan adds a handler to the same logger
+    pan.logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    pan.URL = server.urls(base)
+    pan.session = requests.Session()
+    pan.session.cookies.set('BAIDUID', 'mock')
+    pan.bdstoken = 'mock'
+    pan._mount_adapters()
+    return pan
+
+
+def run(name, args):
+    server = MockPan(args.latency, args.bandwidth << 20, args.error_rate, args.throttle_rate, args.seed)
+    base = server.start()
+    tmp = tempfile.mkdtemp(prefix='bdpan-bench-')
+    try:
+        pan = new_pan(server, base, args)
+        work, files, size, remote_root = SCENARIOS[name](server, pan, tmp, args.scale, random.Random(args.seed))
+        if name.endswith('_download'):
+            shutil.rmtree(tmp)
+            os.makedirs(tmp)
+        server.reset_stats()
+        start = time.perf_counter()
+        work()
+        seconds = time.perf_counter() - start
+        corrupt = mismatches(server, remote_root, tmp)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+    summary = pan.metrics.summary()
+    return {'seconds': seconds, 'files': files, 'bytes': size, 'mib_per_second': size / seconds / (1 << 20),
+            'files_per_second': files / seconds, 'requests': sum(server.calls.values()),
+            'calls': dict(server.calls), 'retries': sum(summary['retries'].values()), 'corrupt': corrupt}
+
+
+def compare(results, baseline, tolerance):
+    # a scenario regresses if its throughput drops, or it sends more requests, by more than tolerance.
+    regressions = []
+    for name, x in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if x['mib_per_second'] < base['mib_per_second'] * (1 - tolerance):
+            regressions.append(f'{name}: {x["mib_per_second"]:.1f} MiB/s, was {base["mib_per_second"]:.1f} MiB/s')
+        if x['requests'] > base['requests'] * (1 + tolerance):
+            regressions.append(f'{name}: {x["requests"]} requests, was {base["requests"]}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks of BdPan against a local mock of Baidu Pan.')
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run. (default: all of {", ".join(SCENARIOS)})')
+    parser.add_argument('--scale', type=int, default=1, help='multiply the number and size of files. (default: 1)')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds added to every request. (default: 0.01)')
+    parser.add_argument('--bandwidth', type=int, default=0, help='MiB/s of every connection, 0 for unlimited. \
+(default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with HTTP 500.')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='fraction of requests throttled by errno 31034.')
+    parser.add_argument('--seed', type=int, default=0, help='seed of file contents and injected errors.')
+    parser.add_argument('--segments', type=int)
+    parser.add_argument('--upload-workers', type=int)
+    parser.add_argument('--list-workers', type=int)
+    parser.add_argument('--transfer-workers', type=int)
+    parser.add_argument('--max-rate', type=float, help='requests per second of BdPan. (default: that of BdPan)')
+    parser.add_argument('-o', '--output', help='save results as JSON, to be used as a baseline later.')
+    parser.add_argument('--baseline', help='compare with results saved before, exit with 1 on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression. (default: 0.2)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the log of BdPan.')
+    args = parser.parse_args()
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [x for x in names if x not in SCENARIOS]
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(unknown)}')
+
+    results = {}
+    print(f'{"scenario":<22}{"seconds":>9}{"MiB/s":>9}{"files/s":>9}{"requests":>10}{"retries":>9}')
+    for name in names:
+        x = results[name] = run(name, args)
+        print(f'{name:<22}{x["seconds"]:>9.2f}{x["mib_per_second"]:>9.1f}{x["files_per_second"]:>9.1f}'
+              f'{x["requests"]:>10}{x["retries"]:>9}')
+        if args.verbose:
+            print('    ' + ', '.join(f'{k}: {v}' for k, v in sorted(x['calls'].items())))
+        if x['corrupt']:
+            print(f'    {len(x["corrupt"])} files are missing or differ: {", ".join(x["corrupt"][:10])}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    failed = [name for name, x in results.items() if x['corrupt']]
+    if failed:
+        print('transferred files do not match: ' + ', '.join(failed))
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for x in regressions:
+            print('regression: ' + x)
+    if failed or regressions:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,4 +3,3 @@ __version__ = '0.2.0'
 from .bdpan import BdPan
 import pyBaiduPan.config
 import pyBaiduPan.exceptions
-import pyBaiduPan.login
@@ -0,0 +1,86 @@
+import io
+from collections import OrderedDict
+
+from pyBaiduPan.exceptions import BdApiError
+
+
+class BdFile(io.RawIOBase):
+    # a read-only, seekable remote file. blocks are fetched with range requests and kept in an LRU cache,
+    # sequential reads fetch several blocks ahead in one request.
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self, pan, meta, block_size=BLOCK_SIZE, cache_size=32 << 20, read_ahead=8):
+        super().__init__()
+        self.pan = pan
+        self.path, self.size = meta['path'], meta['size']
+        self.block_size = block_size
+        self.max_blocks = max(1, cache_size // block_size)
+        self.read_ahead = max(1, min(read_ahead, self.max_blocks))
+        self.cache = OrderedDict()  # block index: bytes
+        self.pos = 0
+        self.last = None  # index of the block read last
+
+    @property
+    def name(self):
+        return self.path
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if self.closed:
+            raise ValueError('seek of closed file.')
+        pos = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence] + offset
+        if pos < 0:
+            raise ValueError(f'negative seek position {pos}')
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError('read of closed file.')
+        view, n = memoryview(b).cast('B'), 0
+        while n < len(view) and self.pos < self.size:
+            index, offset = divmod(self.pos, self.block_size)
+            block = self._block(index)
+            k = min(len(view) - n, len(block) - offset)
+            view[n:n + k] = block[offset:offset + k]
+            n += k
+            self.pos += k
+        return n
+
+    def _block(self, index):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+        else:
+            count = self.read_ahead if self.last is not None and index == self.last + 1 else 1
+            last_block = (self.size - 1) // self.block_size
+            count = next((i for i in range(1, count) if index + i in self.cache or index + i > last_block), count)
+            start = index * self.block_size
+            data = self._fetch(start, min(self.size, start + count * self.block_size))
+            for i in range(count):
+                self.cache[index + i] = data[i * self.block_size:(i + 1) * self.block_size]
+            while len(self.cache) > self.max_blocks:
+                self.cache.popitem(last=False)
+            self.cache.move_to_end(index)
+        self.last = index
+        return self.cache[index]
+
+    def _fetch(self, start, end):
+        headers = {'Range': 'bytes=%d-%d' % (start, end - 1)}
+        res = self.pan.bd_get('download', api='PCS', params={'path': self.path}, headers=headers)
+        if res.status_code != 206 and (start != 0 or end != self.size):
+            raise BdApiError(f'read: range request is not supported for {self.path}')
+        if len(res.content) != end - start:
+            raise BdApiError(f'read: expected {end - start} bytes from {self.path}, got {len(res.content)}')
+        return res.content
+
+    def close(self):
+        self.cache.clear()
+        super().close()
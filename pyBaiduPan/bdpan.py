@@ -1,9 +1,21 @@
 import json
 import os
+import socket
 import re
+import posixpath
 from pyBaiduPan.exceptions import *
-from pyBaiduPan.login import baidu_pan_login
 from pyBaiduPan.config import get_config, DEFAULT_CONFIG
+from pyBaiduPan.hashindex import HashIndex
+from pyBaiduPan.metacache import MetaCache
+from pyBaiduPan.engine import TransferEngine
+from pyBaiduPan.snapshot import Snapshot
+from pyBaiduPan.bdfile import BdFile
+from pyBaiduPan.manifest import Manifest
+from pyBaiduPan.metrics import Metrics, Progress
+from pyBaiduPan.utils import sizeof_fmt
+from pyBaiduPan import planner
+from requests.adapters import HTTPAdapter
+from pyBaiduPan.retry import RateLimiter, classify, backoff, FATAL, THROTTLE
 import logging
 from itertools import count
 import pickle
@@ -13,13 +25,28 @@ from functools import partial
 from base64 import b64encode
 from datetime import datetime
 import time
+from threading import Lock
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
 
 class BdPan:
-    URL = {'PCS': 'https://pcs.baidu.com/rest/2.0/pcs/', 'XPAN': 'https://pan.baidu.com/rest/2.0/xpan/'}
+    URL = {'PCS': 'https://pcs.baidu.com/rest/2.0/pcs/', 'XPAN': 'https://pan.baidu.com/rest/2.0/xpan/',
+           'SHARE': 'https://pan.baidu.com/share/'}
     LIST_LIMIT = 5000
+    LISTALL_LIMIT = 1000
+    FILEMANAGER_LIMIT = 1000
+    ASYNC_THRESHOLD = 100
+    TASK_TIMEOUT = 600  # seconds to wait for an async filemanager task
+    SNAPSHOT_TTL = 3600
     UPLOAD_SIZE = 4 << 20
-    MAX_RETRY = 3
+    UPLOAD_BUFFER = 16 << 20
+    SLICE_SIZE = 256 << 10
+    MAX_RETRY = 5
+    DATA_METHODS = ('download', 'upload')  # PCS methods moving file data
+    POOL_HOSTS = ('https://pcs.baidu.com', 'https://pan.baidu.com', 'https://d.pcs.baidu.com',
+                  'https://', 'http://')  # the last ones for hosts that downloads are redirected to
+    SAVE_INTERVAL = 1 << 20
 
     def __init__(self, config=DEFAULT_CONFIG):
         self.config = config
@@ -29,6 +56,10 @@ class BdPan:
         self._get_logger()
         self.session = None
         self.bdstoken = None
+        self._hash_index = None
+        self.limiter = RateLimiter(config['max_rate'])
+        self.metrics = Metrics()
+        self.meta_cache = MetaCache(config['cache_ttl'], os.path.expanduser(config['meta_cache']))
 
     def _load_session(self, s_file):
         try:
@@ -42,13 +73,7 @@ class BdPan:
         with open(s_file, 'wb') as f:
             pickle.dump(self.session, f)
 
-    @staticmethod
-    def sizeof_fmt(num):
-        for unit in ['B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
-            if abs(num) < 1024.0:
-                return "%3.1f%s" % (num, unit)
-            num /= 1024.0
-        return "%.1f%s" % (num, 'Y')
+    sizeof_fmt = staticmethod(sizeof_fmt)
 
     def _get_bdstoken(self):
         html = self.session.get('https://pan.baidu.com/disk/home').text
@@ -66,33 +91,59 @@ class BdPan:
         ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
         self.logger.addHandler(ch)
 
-    def _bd_request(self, _method, method, path='file', api='XPAN', params={}, skip_errno=(), **kwargs):
-        params['app_id'] = self.config['app_id']
-        params['method'] = method
-        if api == 'XPAN' and self.bdstoken:
+    def _bd_request(self, _method, method, path='file', api='XPAN', params={}, skip_errno=(), retry=True, **kwargs):
+        # retry=False sends one attempt, for callers that retry themselves.
+        params = dict(params, app_id=self.config['app_id'], method=method)  # a copy, requests may run in parallel
+        if api != 'PCS' and self.bdstoken:
             params['bdstoken'] = self.bdstoken
             params['logid'] = b64encode(self.session.cookies['BAIDUID'].encode('ascii'))
-        error = None
-        for i in range(BdPan.MAX_RETRY):
+        limited = not (api == 'PCS' and method in BdPan.DATA_METHODS)  # only metadata requests share the rate limit
+        for i in count():
+            if limited:
+                self.limiter.acquire()
             try:
-                return self._request(_method, BdPan.URL[api] + path, api, skip_errno, params=params, **kwargs)
+                res = self._request(_method, self.URL[api] + path, api, skip_errno, params=params, **kwargs)
             except Exception as e:
-                self.logger.info(f'retrying {i + 1}/{BdPan.MAX_RETRY}')
-                time.sleep(10)
-                error = e
-        raise error
+                if not retry:
+                    raise
+                self._retry_wait(e, i, method)
+            else:
+                if limited:
+                    self.limiter.succeeded()
+                return res
+
+    def _retry_wait(self, error, attempt, what):
+        # raise error if it is fatal or attempts are used up, otherwise wait before the next attempt.
+        kind = classify(error)
+        if kind == THROTTLE:
+            self.limiter.throttled()
+        if kind == FATAL or attempt + 1 >= BdPan.MAX_RETRY:
+            raise error
+        self.metrics.retry(kind)
+        delay = backoff(attempt)
+        self.logger.info(f'retrying {what} {attempt + 1}/{BdPan.MAX_RETRY} in {delay:.1f}s')
+        time.sleep(delay)
 
     @log_error
     def _request(self, method, url, api, skip_errno=(), **kwargs):
-        res = self.session.request(method, url, **kwargs)
-        info = None
-        if api == 'PCS' and res.status_code >= 400:
-            _ = res.content
-            info = res.json()
-        elif api == 'XPAN' and res.json().get('errno') not in (None, 0):
-            info = res.json()
-        if info is not None and info.get('errno') not in skip_errno and info.get('error_code') not in skip_errno:
-            raise BdApiError((method, res.url, info))
+        kwargs.setdefault('timeout', (self.config['connect_timeout'], self.config['read_timeout']))
+        name, start, errno = kwargs.get('params', {}).get('method', ''), time.perf_counter(), None
+        try:  # latency of a streamed response is the time until its headers arrive
+            res = self.session.request(method, url, **kwargs)
+            info = None
+            if api == 'PCS' and res.status_code >= 400:
+                _ = res.content
+                info = res.json()
+            elif api != 'PCS' and res.json().get('errno') not in (None, 0):
+                info = res.json()
+            if info is not None:
+                errno = info.get('errno', info.get('error_code'))
+            if info is not None and info.get('errno') not in skip_errno and info.get('error_code') not in skip_errno:
+                raise BdApiError((method, res.url, info), errno=errno, status=res.status_code)
+        except Exception:
+            self.metrics.request(api, name, time.perf_counter() - start, errno, True)
+            raise
+        self.metrics.request(api, name, time.perf_counter() - start, errno)
         return res
 
     @log_error
@@ -102,10 +153,30 @@ class BdPan:
         self._load_session(s_file)
         self.bdstoken = mute_error(self._get_bdstoken)()
         if self.bdstoken is None:
+            from pyBaiduPan.login import baidu_pan_login  # Flask is only imported when it is needed
             self.session = baidu_pan_login(host, port)
             self.bdstoken = self._get_bdstoken()
+        self._mount_adapters()
         self._save_session(s_file)
 
+    def _mount_adapters(self):
+        # every worker may hold a connection at the same time, the pool is sized so none of them is discarded.
+        c = self.config
+        size = c['transfer_workers'] * max(c['segments'], c['upload_workers']) + c['list_workers']
+        for prefix in BdPan.POOL_HOSTS:
+            self.session.mount(prefix, HTTPAdapter(pool_connections=16, pool_maxsize=size))
+
+    def connection_stats(self):
+        # host: (requests, connections), requests - connections is the number of reused connections.
+        stats = {}
+        for adapter in {id(x): x for x in self.session.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                n = stats.get(pool.host, (0, 0))
+                stats[pool.host] = (n[0] + pool.num_requests, n[1] + pool.num_connections)
+        return stats
+
     @log_error
     def logout(self, s_file=None):
         s_file = s_file or self.config['session']
@@ -115,25 +186,187 @@ class BdPan:
             pass
         self.session = None
         self.bdstoken = None
+        self.meta_cache.clear()
+        self.meta_cache.save()
 
     def download_file(self, file_info, f_path, overwrite='none'):
-        bd_path = file_info['path']
+        bd_path, size = file_info['path'], file_info['size']
         f_path = os.path.join(f_path, os.path.split(bd_path)[1]) if os.path.isdir(f_path) else f_path
         if os.path.exists(f_path) and (overwrite == 'none'
                                        or (overwrite == 'mtime' and self._compare_mtime(f_path, file_info, 'ge'))):
             return
         self.logger.info(f'download {bd_path} to {f_path}')
-        headers = {}
-        if os.path.exists(f_path + '.part'):
-            headers['Range'] = 'bytes=%d-' % os.path.getsize(f_path + '.part')
-        with self.bd_get('download', api='PCS', params={'path': bd_path}, headers=headers, stream=True) as r:
-            with open(f_path + '.part', 'ab') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        shutil.move(f_path + '.part', f_path)
+        part, state_file = f_path + '.part', f_path + '.part.seg'
+        state = self._load_state(state_file, size)
+        if state is None:
+            state = {'size': size, 'segments': self._split_segments(part, size), 'blocks': {}}
+        with open(part, 'r+b' if os.path.exists(part) else 'wb') as f:
+            f.truncate(size)  # preallocate, so segments can be written at their own offsets
+        verify = self.config['verify']
+        with self.metrics.phase('download'):
+            if verify:
+                self._check_journal(part, state)
+            self._download_segments(bd_path, part, state_file, state, verify)
+            if verify:
+                self._verify_download(file_info, part, state_file, state)
+        self.metrics.add_file('download')
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        shutil.move(part, f_path)
         # there is no simple way to modify ctime. so I decide to leave it there.
         os.utime(f_path, (file_info['local_mtime'], file_info['local_mtime']))
 
+    def open(self, path, **kwargs):
+        meta = self.meta(path)
+        if meta['isdir'] == 1:
+            raise IsADirectoryError(path)
+        return BdFile(self, meta, **kwargs)
+
+    def _split_segments(self, part, size):
+        if os.path.exists(part):  # .part left by a single connection download, resume it as one segment
+            return [[0, size, min(os.path.getsize(part), size)]]
+        n = max(1, min(self.config['segments'], size // (self.config['min_segment_size'] << 20)))
+        # segments are aligned to blocks, so the checksum of every block is computed by one segment.
+        bounds = [size * i // n // BdPan.UPLOAD_SIZE * BdPan.UPLOAD_SIZE for i in range(n)] + [size]
+        return [[bounds[i], bounds[i + 1], bounds[i]] for i in range(n)]
+
+    @staticmethod
+    def _load_state(state_file, size):
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if state.get('size') == size:
+            state.setdefault('blocks', {})
+            return state
+
+    @staticmethod
+    def _save_state(state_file, state, lock):
+        with lock:
+            with open(state_file, 'w') as f:
+                json.dump(state, f)
+
+    @staticmethod
+    def _record_block(blocks, lock, index, digest):
+        with lock:
+            blocks[str(index)] = digest
+
+    def _download_segments(self, bd_path, part, state_file, state, verify=False):
+        pending = [x for x in state['segments'] if x[2] < x[1]]
+        if not pending:
+            return
+        lock = Lock()
+        save = partial(self._save_state, state_file, state, lock)
+        record = partial(self._record_block, state['blocks'], lock) if verify else None
+        save()
+        with ThreadPoolExecutor(min(len(pending), self.config['segments'])) as pool:  # at most segments connections
+            for _ in pool.map(partial(self._download_segment, bd_path, part, state['size'], save=save,
+                                      record=record), pending):
+                pass
+
+    def _download_segment(self, bd_path, part, size, seg, save, record=None):
+        hasher = [md5()]  # md5 of the current block, if checksums are recorded
+        for i in count():
+            try:
+                headers = {'Range': 'bytes=%d-%d' % (seg[2], seg[1] - 1)}
+                with self.bd_get('download', api='PCS', params={'path': bd_path}, headers=headers, stream=True,
+                                 retry=False) as r:  # retried here, also when the body breaks off
+                    if r.status_code != 206 and (seg[2] != 0 or seg[1] != size):
+                        raise BdApiError(f'download: range request is not supported for {bd_path}')
+                    with open(part, 'r+b') as f:
+                        f.seek(seg[2])
+                        saved = seg[2]
+                        for chunk in r.iter_content(chunk_size=8192):
+                            chunk = chunk[:seg[1] - seg[2]]
+                            f.write(chunk)
+                            if record is not None:
+                                self._hash_chunk(seg[2], chunk, size, hasher, record)
+                            seg[2] += len(chunk)
+                            self.metrics.add_bytes('download', len(chunk))
+                            if seg[2] - saved >= BdPan.SAVE_INTERVAL:
+                                f.flush()
+                                save()
+                                saved = seg[2]
+                if seg[2] < seg[1]:
+                    raise BdApiError(f'download: connection closed before the end of segment {seg[:2]}')
+                save()
+                return
+            except Exception as e:
+                self._retry_wait(e, i, f'segment {seg[:2]} of {bd_path}')
+
+    @staticmethod
+    def _hash_chunk(pos, chunk, size, hasher, record):
+        # the data is hashed as it streams in, a block is recorded once its last byte is written.
+        while chunk:
+            index = pos // BdPan.UPLOAD_SIZE
+            end = min((index + 1) * BdPan.UPLOAD_SIZE, size)
+            hasher[0].update(chunk[:end - pos])
+            if len(chunk) >= end - pos:
+                record(index, hasher[0].hexdigest())
+                hasher[0] = md5()
+            chunk, pos = chunk[end - pos:], min(end, pos + len(chunk))
+
+    @staticmethod
+    def _check_journal(part, state):
+        # a segment is resumed from its first block that is not recorded or does not match its checksum,
+        # instead of trusting whatever is in .part.
+        blocks, size = state['blocks'], state['size']
+        if any(seg[0] % BdPan.UPLOAD_SIZE for seg in state['segments']):  # not aligned, written without checksums
+            state['segments'], state['blocks'] = [[0, size, 0]], {}
+            return
+        with open(part, 'rb') as f:
+            for seg in state['segments']:
+                index = seg[0] // BdPan.UPLOAD_SIZE
+                while True:
+                    start, end = index * BdPan.UPLOAD_SIZE, min((index + 1) * BdPan.UPLOAD_SIZE, size)
+                    if start >= seg[1] or end > seg[2] or str(index) not in blocks:
+                        break
+                    f.seek(start)
+                    if md5(f.read(end - start)).hexdigest() != blocks[str(index)]:
+                        break
+                    index += 1
+                seg[2] = min(seg[2], max(seg[0], index * BdPan.UPLOAD_SIZE))
+                for i in range(index, -(-seg[1] // BdPan.UPLOAD_SIZE)):
+                    blocks.pop(str(i), None)
+
+    def _remote_blocks(self, path):
+        res = mute_error(self.bd_get)('meta', api='PCS', params={'path': path})
+        try:
+            block_list = res.json()['list'][0]['block_list']
+            return json.loads(block_list) if isinstance(block_list, str) else block_list
+        except Exception:
+            return
+
+    def _verify_download(self, file_info, part, state_file, state):
+        size, n = state['size'], -(-state['size'] // BdPan.UPLOAD_SIZE)
+        if size == 0:
+            return
+        remote = self._remote_blocks(file_info['path'])
+        if remote is None or len(remote) != n:
+            if n != 1:
+                self.logger.info(f'unable to verify {file_info["path"]}, its block list is not available')
+                return
+            remote = [file_info['md5']]
+        for attempt in range(2):
+            bad = [i for i in range(n) if state['blocks'].get(str(i)) != remote[i]]
+            if not bad:
+                return
+            if attempt:
+                break
+            self.logger.info(f'download {len(bad)} corrupt blocks of {file_info["path"]} again')
+            for i in bad:
+                state['blocks'].pop(str(i), None)
+            state['segments'] = []
+            for i in bad:  # adjacent blocks are fetched by one range request
+                start, end = i * BdPan.UPLOAD_SIZE, min((i + 1) * BdPan.UPLOAD_SIZE, size)
+                if state['segments'] and state['segments'][-1][1] == start:
+                    state['segments'][-1][1] = end
+                else:
+                    state['segments'].append([start, end, start])
+            self._download_segments(file_info['path'], part, state_file, state, True)
+        raise BdApiError(f'verify: {len(bad)} blocks of {file_info["path"]} do not match.')
+
     def meta(self, path, ignore_file_not_exist=False):
         if path == '/':
             return {"server_filename": "", "local_mtime": 1520000000, "size": 0, "isdir": 1, "path": "/"}  # fake meta
@@ -142,47 +375,120 @@ class BdPan:
             if ignore_file_not_exist:
                 return
             raise BdApiError('file not found.')
-        metas = [x for x in self.bd_get('search', params=params).json()['list'] if x['path'] == path]
-        if len(metas) != 1:
+        hit, meta = self.meta_cache.get_meta(path)
+        if not hit:
+            metas = [x for x in self.bd_get('search', params=params).json()['list'] if x['path'] == path]
+            meta = metas[0] if len(metas) == 1 else None
+            if meta is not None:
+                self.meta_cache.put_meta(meta)
+        if meta is None:
             if ignore_file_not_exist:
                 return
             raise BdApiError('file not found.')
-        return metas[0]
+        return meta
+
+    def metas(self, paths):
+        # paths sharing a parent directory are resolved by one listing of it, instead of one search per path.
+        ret, groups = {}, {}
+        for path in {x.rstrip('/') or '/' for x in paths}:
+            hit, meta = self.meta_cache.get_meta(path)
+            if hit or path == '/':
+                ret[path] = meta if hit else self.meta(path)
+            else:
+                groups.setdefault(os.path.split(path)[0], []).append(path)
+        for parent, group in groups.items():
+            if len(group) == 1:
+                ret[group[0]] = self.meta(group[0], True)
+            else:
+                ls = {x['path']: x for x in self._list(parent, True)}
+                ret.update({x: ls.get(x) for x in group})
+        return [ret[x.rstrip('/') or '/'] for x in paths]
+
+    def _list_pages(self, path):
+        for i in count(step=BdPan.LIST_LIMIT):
+            with self.metrics.phase('list'):
+                res = self.bd_get('list', params={'dir': path, 'limit': BdPan.LIST_LIMIT, 'start': i},
+                                  skip_errno=(-9,)).json()  # -9: dir not exist, which lists as empty
+            yield res.get('list', [])
+            if len(res.get('list', [])) < BdPan.LIST_LIMIT:
+                break
+
+    def iter_list(self, path, known_dir=False):
+        # yield entries page by page, only a listing of a single page is cached.
+        if not known_dir:
+            meta = self.meta(path)
+            if meta['isdir'] == 0:
+                yield meta
+                return
+        ls = self.meta_cache.get_list(path)
+        if ls is not None:
+            yield from ls
+            return
+        for i, page in enumerate(self._list_pages(path)):
+            if i == 0 and len(page) < BdPan.LIST_LIMIT:
+                self.meta_cache.put_list(path, page)
+            yield from page
 
     def _list(self, path, known_dir=False):
         if not known_dir:
             ret = [self.meta(path)]
         if known_dir or ret[0]['isdir'] == 1:
-            ret = []
-            for i in count(step=BdPan.LIST_LIMIT):
-                res = self.bd_get('list', params={'dir': path, 'limit': BdPan.LIST_LIMIT, 'start': i}).json()
-                ret += res['list']
-                if len(res['list']) < BdPan.LIST_LIMIT:
-                    break
+            ret = self.meta_cache.get_list(path)
+            if ret is None:
+                ret = [x for page in self._list_pages(path) for x in page]
+                self.meta_cache.put_list(path, ret)
         return ret
 
+    def snapshot(self, path):
+        path = path.rstrip('/') or '/'
+        snapshot, start = Snapshot(path), 0
+        while True:
+            with self.metrics.phase('list'):
+                res = self.bd_get('listall', 'multimedia', params={'path': path, 'recursion': 1, 'start': start,
+                                                                   'limit': BdPan.LISTALL_LIMIT}).json()
+            for x in res['list']:
+                snapshot.add(x)
+            if not res.get('has_more'):
+                break
+            start = res['cursor']
+        self.logger.info(f'snapshot {path}: {len(snapshot)} files and directories')
+        # every directory of the snapshot is served from the cache, so walking the tree needs no more listing.
+        ttl = max(self.config['cache_ttl'], BdPan.SNAPSHOT_TTL)
+        for d, ls in snapshot.children.items():
+            self.meta_cache.put_list(d, ls, ttl)
+        return snapshot
+
     @log_error
     def list(self, path=None, show=True):
         path = path or self.config['pan_path']
-        ls = self._list(path)
-        if show:
-            for i in ls:
-                print(['F', 'D'][i['isdir']], '%6s' % self.sizeof_fmt(i['size']),
-                      datetime.fromtimestamp(i['local_mtime']).strftime('%Y-%m-%dT%H:%M:%S'),
-                      os.path.split(i['path'])[1])
+        if not show:
+            return self._list(path)
+        ls = []
+        for i in self.iter_list(path):  # entries are printed as they are listed, and returned as before
+            print(['F', 'D'][i['isdir']], '%6s' % self.sizeof_fmt(i['size']),
+                  datetime.fromtimestamp(i['local_mtime']).strftime('%Y-%m-%dT%H:%M:%S'),
+                  os.path.split(i['path'])[1])
+            ls.append(i)
         return ls
 
-    def _download(self, bd_path, l_path, known_dir=False, overwrite='none', delete_extra=False):
-        f_info = self._list(bd_path, known_dir)
-        for i in f_info:
-            if i['isdir']:
-                local_dir = os.path.join(l_path, os.path.split(i['path'])[1])
-                os.makedirs(local_dir, exist_ok=True)
-                self._download(i['path'], local_dir, True, overwrite, delete_extra)
-            else:
-                self.download_file(i, l_path, overwrite)
-        if delete_extra and os.path.isdir(l_path):
-            f_name = [os.path.split(i['path'])[1] for i in f_info]
+    def _download(self, engine, bd_path, l_path, known_dir=False, overwrite='none', delete_extra=False):
+        f_name = set()
+
+        def files():  # the listing is streamed, files are queued for transfer as soon as they are listed
+            for i in self.iter_list(bd_path, known_dir):
+                f_name.add(os.path.split(i['path'])[1])
+                if i['isdir']:
+                    local_dir = os.path.join(l_path, os.path.split(i['path'])[1])
+                    os.makedirs(local_dir, exist_ok=True)
+                    engine.list(partial(self._download, engine, i['path'], local_dir, True, overwrite, delete_extra))
+                else:
+                    yield partial(self.download_file, i, l_path, overwrite)
+
+        # extra files are deleted once all files of the directory are downloaded, as their .part files are in it.
+        engine.transfer_all(files(), partial(self._delete_local_extra, l_path, f_name) if delete_extra else None)
+
+    def _delete_local_extra(self, l_path, f_name):
+        if os.path.isdir(l_path):
             for f in os.listdir(l_path):
                 if f not in f_name:
                     try:
@@ -191,6 +497,9 @@ class BdPan:
                         os.remove(os.path.join(l_path, f))
                     self.logger.info(f'delete extra: {os.path.join(l_path, f)}')
 
+    def _engine(self):
+        return TransferEngine(self.config['list_workers'], self.config['transfer_workers'])
+
     @log_error
     def download(self, src=None, dst=None, overwrite=None, delete_extra=None):
         src = src or self.config['pan_path']
@@ -199,53 +508,236 @@ class BdPan:
         delete_extra = delete_extra or self.config['delete_extra']
         if self.meta(src)['isdir'] == 1:
             os.makedirs(dst, exist_ok=True)
-        self._download(src, dst, overwrite=overwrite, delete_extra=delete_extra)
+            if self.config['snapshot']:
+                self.snapshot(src)
+        engine = self._engine()
+        engine.list(partial(self._download, engine, src, dst, overwrite=overwrite, delete_extra=delete_extra))
+        engine.wait()
 
     @staticmethod
-    def file_slice(file, size=UPLOAD_SIZE):
-        if os.path.getsize(file) == 0:
-            yield b''
-            return
+    def hash_file(file, keep=False):
+        content_md5, slice_md5, block_list, blocks = md5(), None, [], []
+        buf = bytearray(BdPan.UPLOAD_SIZE)  # reused for every block, unless the blocks are kept for uploading
+        with open(file, 'rb') as f:
+            for i in count():
+                n = f.readinto(buf)
+                if n == 0 and i > 0:
+                    break
+                view = memoryview(buf)[:n]
+                if i == 0:
+                    slice_md5 = md5(view[:BdPan.SLICE_SIZE]).hexdigest()
+                content_md5.update(view)
+                block_list.append(md5(view).hexdigest())
+                if keep:
+                    blocks.append(bytes(view))
+                if n < len(buf):
+                    break
+        return content_md5.hexdigest(), slice_md5, block_list, blocks if keep else None
+
+    @property
+    def hash_index(self):
+        if self._hash_index is None and self.config.get('hash_index'):
+            self._hash_index = HashIndex(os.path.expanduser(self.config['hash_index']), self.config['hash_index_size'])
+        return self._hash_index
+
+    def _hash(self, f_path, keep=False):
+        index = self.hash_index
+        if index is not None and not self.config.get('rehash'):
+            hashes = index.get(f_path)
+            if hashes is not None:
+                return hashes + (None,)
+        key = HashIndex.key(f_path)
+        with self.metrics.phase('hash'):
+            hashes = self.hash_file(f_path, keep)
+        self.metrics.add_bytes('hash', key[2])
+        if index is not None and HashIndex.key(f_path) == key:  # not if the file changed while it was hashed
+            index.put(key, *hashes[:3])
+        return hashes
+
+    @staticmethod
+    def _read_slices(file, buffers):
         with open(file, 'rb') as f:
-            for c in iter(partial(f.read, size), b''):
-                yield c
+            for i in count():
+                buf = buffers.get()
+                n = f.readinto(buf)
+                if n == 0 and i > 0:
+                    buffers.put(buf)
+                    break
+                yield memoryview(buf)[:n], partial(buffers.put, buf)
+                if n < len(buf):
+                    break
 
     def upload_file(self, bd_path, f_path, overwrite='none', meta=None):
         if meta is not None and (
                 overwrite == 'none' or (overwrite == 'mtime' and self._compare_mtime(f_path, meta, 'le'))):
             return
         self.logger.info(f'upload {f_path} to {bd_path}')
-        content_md5, block_list = md5(), []
-        for x in self.file_slice(f_path):
-            content_md5.update(x)
-            block_list.append(md5(x).hexdigest())
-        content_md5, block_list = content_md5.hexdigest(), json.dumps(block_list)
-        slice_md5 = md5(next(self.file_slice(f_path, 256 << 10))).hexdigest()
-        data = {'path': bd_path, 'size': os.path.getsize(f_path), 'isdir': "0", 'autoinit': 1, 'block_list': block_list,
+        size = os.path.getsize(f_path)
+        # small files are read only once, the kept blocks are uploaded without reading the file again.
+        content_md5, slice_md5, block_list, blocks = self._hash(f_path, size <= BdPan.UPLOAD_BUFFER)
+        data = {'path': bd_path, 'size': size, 'isdir': "0", 'autoinit': 1, 'block_list': json.dumps(block_list),
                 'rtype': 0 if overwrite == 'none' else 3, 'content-md5': content_md5, "slice-md5": slice_md5,
                 'local_ctime': round(os.path.getctime(f_path)), 'local_mtime': round(os.path.getmtime(f_path))}
         res = self.bd_post('precreate', data=data).json()
         if res['return_type'] == 2:  # rapid upload
-            return res['info']
+            if self.config['verify']:
+                self._verify_upload(res['info'], size, block_list)
+            self.metrics.add_file('rapid_upload')
+            return self._created(res['info'], data)
         params = {'type': 'tmpfile', 'path': bd_path, 'uploadid': res['uploadid']}
-        for i, x in enumerate(self.file_slice(f_path)):
-            params['partseq'] = i
-            self.bd_post('upload', 'superfile2', api='PCS', params=params, files={'file': x})
+        with self.metrics.phase('upload'):
+            if blocks is not None:
+                self._upload_parts(params, ((x, None) for x in blocks))
+            else:
+                buffers = Queue()  # slices in flight, which bounds the memory usage
+                for _ in range(self.config['upload_workers'] * 2):
+                    buffers.put(bytearray(BdPan.UPLOAD_SIZE))
+                self._upload_parts(params, self._read_slices(f_path, buffers))
         fields = ('path', 'size', 'isdir', 'block_list', 'rtype', 'local_ctime', 'local_mtime')
         data = {k: v for k, v in data.items() if k in fields}
         data['uploadid'] = params['uploadid']
-        return self.bd_post('create', data=data).json()
+        res = self.bd_post('create', data=data).json()
+        if self.config['verify']:
+            self._verify_upload(res, size, block_list)
+        self.metrics.add_file('upload')
+        return self._created(res, data)
+
+    def _verify_upload(self, info, size, block_list):
+        if info['size'] != size:
+            raise BdApiError(f'verify: {info["path"]} has {info["size"]} bytes, {size} bytes are uploaded.')
+        remote = self._remote_blocks(info['path'])
+        if remote is not None and remote != block_list:
+            raise BdApiError(f'verify: block list of {info["path"]} does not match the uploaded file.')
+
+    def _created(self, info, data):
+        # create does not return local times, take them from the request so the cached meta is complete.
+        meta = dict(info, local_ctime=data['local_ctime'], local_mtime=data['local_mtime'],
+                    server_filename=os.path.split(info['path'])[1])
+        self.meta_cache.put_meta(meta)
+        return info
+
+    def _upload_parts(self, params, slices):
+        with ThreadPoolExecutor(self.config['upload_workers']) as pool:
+            futures = []
+            for i, (x, release) in enumerate(slices):
+                if any(f.done() and f.exception() is not None for f in futures):
+                    if release is not None:
+                        release()
+                    break
+                futures.append(pool.submit(self._upload_part, params, i, x, release))
+            for f in futures:
+                f.result()
+
+    def _upload_part(self, params, partseq, data, release=None):
+        try:  # each part is retried on its own by _bd_request
+            self.bd_post('upload', 'superfile2', api='PCS', params=dict(params, partseq=partseq), files={'file': data})
+            self.metrics.add_bytes('upload', len(data))
+        finally:
+            if release is not None:
+                release()
 
     def makedir(self, path):
         data = {'path': path, 'size': 0, 'isdir': "1", 'block_list': '[]', 'rtype': 0}
-        self.bd_post('create', data=data, skip_errno=(-8,))  # -8: dir already exist
+        res = self.bd_post('create', data=data, skip_errno=(-8,)).json()  # -8: dir already exist
+        if res.get('errno') == 0:
+            self.meta_cache.put_meta(dict(res, local_ctime=res['ctime'], local_mtime=res['mtime'],
+                                          server_filename=os.path.split(res['path'])[1]))
+            self.meta_cache.put_list(res['path'], [])  # a new directory is empty
+
+    def _filemanager(self, opera, filelist):
+        # return the items that failed. large batches run as async tasks.
+        failed = []
+        for i in range(0, len(filelist), BdPan.FILEMANAGER_LIMIT):
+            chunk = filelist[i:i + BdPan.FILEMANAGER_LIMIT]
+            mode = 2 if len(chunk) > BdPan.ASYNC_THRESHOLD else 0
+            res = self.bd_post('filemanager', params={'opera': opera, 'async': mode, 'onnest': 'fail'},
+                               data={'filelist': json.dumps(chunk), 'ondup': 'fail'},
+                               skip_errno=(12,)).json()  # 12: some of the items failed
+            if mode == 2:
+                res = self._wait_task(res['taskid'], chunk)
+            failed += [x for x in res.get('info', []) if x.get('errno')]
+        return failed
+
+    def _wait_task(self, taskid, chunk):
+        deadline = time.monotonic() + BdPan.TASK_TIMEOUT
+        for i in count():
+            res = self.bd_post('taskquery', 'taskquery', api='SHARE', params={'taskid': taskid}).json()
+            if res.get('status') in ('success', 'failed'):
+                # items of the task, if Baidu lists them, tell which of them failed
+                items = [{'path': x.get('path', x.get('from')), 'errno': x.get('errno', 0)}
+                         for x in res.get('list') or () if isinstance(x, dict)]
+                if items or res['status'] == 'success':
+                    return {'info': items}
+                return {'info': [{'path': x if isinstance(x, str) else x['path'], 'errno': res.get('task_errno', -1)}
+                                 for x in chunk]}
+            if time.monotonic() >= deadline:
+                self.logger.error(f'task {taskid} did not finish in {BdPan.TASK_TIMEOUT}s')
+                return {'info': [{'path': x if isinstance(x, str) else x['path'], 'errno': -1} for x in chunk]}
+            time.sleep(min(1 + i, 5))
+
+    def _report(self, opera, failed):
+        for x in failed:
+            self.logger.error(f'{opera} failed: {x.get("path")} (errno: {x.get("errno")})')
+        return failed
 
     def remove(self, *path):
         if len(path) == 0:
-            return
+            return []
         self.logger.info(f'remove: {path}')
-        self.bd_post('filemanager', params={'opera': 'delete', 'async': 0, 'onnest': 'fail'},
-                     data={'filelist': json.dumps(path)})
+        failed = self._filemanager('delete', list(path))
+        self.meta_cache.remove(*path)
+        return self._report('remove', failed)
+
+    def _relocate(self, opera, pairs):
+        pairs = [(src.rstrip('/'), dst.rstrip('/')) for src, dst in pairs]
+        if not pairs:
+            return []
+        self.logger.info(f'{opera}: {pairs}')
+        filelist = [{'path': src, 'newname': os.path.split(dst)[1]} if opera == 'rename' else
+                    {'path': src, 'dest': os.path.split(dst)[0] or '/', 'newname': os.path.split(dst)[1],
+                     'ondup': 'fail'} for src, dst in pairs]
+        failed = self._filemanager(opera, filelist)
+        if opera != 'copy':
+            self.meta_cache.remove(*[src for src, dst in pairs])
+        self.meta_cache.invalidate(*[dst for src, dst in pairs])
+        return self._report(opera, failed)
+
+    def move(self, *pairs):
+        return self._relocate('move', pairs)
+
+    def copy(self, *pairs):
+        return self._relocate('copy', pairs)
+
+    def rename(self, *pairs):
+        return self._relocate('rename', pairs)
+
+    def _op_paths(self, src, dst):
+        src = src or self.config['pan_path']
+        dst = dst or self.config['local_path']
+        if not dst.startswith('/'):
+            raise RuntimeError('the destination must be an absolute path in Baidu Pan.')
+        meta = self.meta(dst, True)
+        if meta is not None and meta['isdir'] == 1:  # into an existing directory
+            dst = posixpath.join(dst, os.path.split(src.rstrip('/'))[1])
+        return src, dst
+
+    @log_error
+    def mv(self, src=None, dst=None):
+        if self.move(self._op_paths(src, dst)):
+            raise BdApiError('mv: failed.')
+
+    @log_error
+    def cp(self, src=None, dst=None):
+        if self.copy(self._op_paths(src, dst)):
+            raise BdApiError('cp: failed.')
+
+    @log_error
+    def rm(self, *path):
+        path = path or (self.config['pan_path'],)
+        if any((x.rstrip('/') or '/') == '/' for x in path):
+            raise RuntimeError('rm: refuse to remove "/".')
+        if self.remove(*path):
+            raise BdApiError('rm: failed.')
 
     @log_error
     def upload(self, src=None, dst=None, overwrite=None, delete_extra=None):
@@ -262,40 +754,148 @@ class BdPan:
         elif os.path.isdir(src):
             if meta is not None and meta['isdir'] == 0:
                 raise RuntimeError('upload: unable to upload a directory to a file.')
-            for root, dirs, files in os.walk(src):
-                r_path = os.path.relpath(root, src)
-                bd_path = os.path.join(dst, r_path if r_path != '.' else '').replace('\\', '/')
-                self.makedir(bd_path)
-                f_info = {f: None for f in files}
-                if overwrite != 'force':
-                    bd_dir = self._list(bd_path, True)
-                    for x in bd_dir:
-                        k = os.path.split(x['path'])[1]
-                        if k in f_info:
-                            f_info[k] = x
-                for f, m in f_info.items():
-                    self.upload_file(os.path.join(bd_path, f).replace('\\', '/'), os.path.join(root, f), overwrite, m)
-                if delete_extra:
-                    if overwrite == 'force':
-                        bd_dir = self._list(bd_path, True)
-                    d_f = [x['path'] for x in bd_dir if os.path.split(x['path'])[1] not in files + dirs]
-                    self.remove(*d_f)
+            if self.config['snapshot'] and meta is not None and (delete_extra or overwrite != 'force'):
+                self.snapshot(dst)
+            engine, extra = self._engine(), [] if delete_extra else None
+            engine.list(partial(self._upload, engine, src, dst, overwrite, extra))
+            engine.wait()
+            if extra:  # extra files and directories of the whole tree are removed in batches
+                self.remove(*extra)
         else:
             raise RuntimeError('upload: local_path must be a file or a directory.')
 
-    def sync(self, pan_path=None, local_path=None, overwrite=None):
+    def _upload(self, engine, l_path, bd_path, overwrite='none', extra=None):
+        hit, meta = self.meta_cache.get_meta(bd_path)
+        if not hit or meta is None or meta['isdir'] == 0:  # skip directories known to exist
+            self.makedir(bd_path)
+        dirs, files = [], []
+        with os.scandir(l_path) as it:
+            for x in it:  # classified the same way as os.walk, links to directories are not followed
+                (dirs if x.is_dir() else files).append(x)
+        for x in dirs:
+            if not x.is_symlink():
+                engine.list(partial(self._upload, engine, x.path, posixpath.join(bd_path, x.name), overwrite, extra))
+        bd_files = [posixpath.join(bd_path, x.name) for x in files]
+        f_info = self.metas(bd_files) if overwrite != 'force' else [None] * len(files)
+        engine.transfer_all([partial(self.upload_file, bd_f, x.path, overwrite, m)
+                             for x, bd_f, m in zip(files, bd_files, f_info)])
+        if extra is not None:
+            names = {x.name for x in dirs + files}
+            extra.extend(x['path'] for x in self._list(bd_path, True) if os.path.split(x['path'])[1] not in names)
+
+    @log_error
+    def sync(self, pan_path=None, local_path=None, overwrite=None, dry_run=None):
         local_path = local_path or self.config['local_path']
         pan_path = pan_path or self.config['pan_path']
-        overwrite = overwrite or self.config['overwrite']
-        self.download(pan_path, local_path, overwrite, False)
-        self.upload(local_path, pan_path, overwrite, False)
+        overwrite = overwrite or self.config['overwrite'] or 'none'
+        dry_run = dry_run or self.config['dry_run']
+        meta = self.meta(pan_path, True)
+        if os.path.isfile(local_path) or (meta is not None and meta['isdir'] == 0):
+            self.download(pan_path, local_path, overwrite, False)
+            self.upload(local_path, pan_path, overwrite, False)
+            return
+        manifest = None
+        if self.config['incremental']:
+            manifest = Manifest(os.path.expanduser(self.config['manifest_dir']), pan_path, local_path)
+        local, dirs_mtime = planner.scan_local(local_path, manifest) if os.path.isdir(local_path) else ({}, {})
+        remote = planner.scan_remote(self.snapshot(pan_path)) if meta is not None else {}
+        plan = planner.plan(local_path, pan_path, local, remote, overwrite, meta is not None)
+        if dry_run:
+            self.print_plan(plan)
+        else:
+            self.execute_plan(plan)
+            if manifest is not None:
+                self._update_manifest(manifest, plan, dirs_mtime)
+        return plan
+
+    def print_plan(self, plan):
+        for op in ('download', 'upload', 'conflict'):
+            for rel, l, r in plan.ops[op]:
+                size = (r if op == 'download' else l or r)['size']
+                print(op[0].upper(), '%6s' % self.sizeof_fmt(size), rel)
+        for op, (n, size) in plan.summary().items():
+            print(f'{op}: {n}' + (f' ({self.sizeof_fmt(size)})' if op in ('download', 'upload') else ''))
+
+    def _update_manifest(self, manifest, plan, dirs_mtime):
+        manifest.files = {}
+        for op in ('skip', 'download', 'upload'):
+            for rel, l, r in plan.ops[op]:
+                if (l or r)['isdir']:
+                    continue
+                if op == 'upload':  # meta of the uploaded file, if it is still cached
+                    r = self.meta_cache.get_meta(plan.remote(rel))[1] or {}
+                size, mtime = (r['size'], r['local_mtime']) if op == 'download' else (l['size'], l['mtime'])
+                manifest.files[rel] = {'size': size, 'mtime': mtime, 'md5': r.get('md5'), 'fs_id': r.get('fs_id')}
+        # directories changed by this sync are stat again, so the next run does not scan them for nothing.
+        changed = {posixpath.split(rel)[0] for op in ('download', 'mkdir_local') for rel, l, r in plan.ops[op]}
+        changed |= {rel for rel, l, r in plan.ops['mkdir_local']}
+        for rel in changed:
+            path = plan.local(rel) if rel else plan.local_path
+            if os.path.isdir(path):
+                dirs_mtime[rel] = os.stat(path).st_mtime_ns
+        manifest.dirs = dirs_mtime
+        manifest.save()
+
+    def execute_plan(self, plan):
+        for rel, l, r in plan.ops['conflict']:
+            self.logger.info(f'conflict, skipped: {plan.local(rel)} and {plan.remote(rel)}')
+        os.makedirs(plan.local_path, exist_ok=True)
+        for rel, l, r in plan.ops['mkdir_local']:
+            os.makedirs(plan.local(rel), exist_ok=True)
+        for rel, l, r in plan.ops['download']:
+            os.makedirs(os.path.split(plan.local(rel))[0], exist_ok=True)
+        engine = self._engine()
+        if not plan.root_exists:
+            engine.list(partial(self.makedir, plan.pan_path))
+        for rel, l, r in plan.ops['mkdir_remote']:
+            engine.list(partial(self.makedir, plan.remote(rel)))
+        for rel, l, r in plan.ops['download']:
+            engine.transfer(partial(self.download_file, r, plan.local(rel), 'force'))
+        for rel, l, r in plan.ops['upload']:  # parent directories are created by create as well
+            engine.transfer(partial(self.upload_file, plan.remote(rel), plan.local(rel), 'force', r))
+        engine.wait()
+
+    def daemon(self):
+        from pyBaiduPan.daemon import Daemon
+        Daemon(self).run()
 
 
 def main():
     try:
-        pan = BdPan(get_config())
+        config = get_config()
+        res = None
+        if hasattr(socket, 'AF_UNIX'):  # a running daemon saves login, listing and hashing, not on Windows
+            from pyBaiduPan.daemon import Daemon, send, request_from
+            if config['action'] in Daemon.COMMANDS:
+                try:
+                    res = send(os.path.expanduser(config['socket']), request_from(config))
+                except OSError:
+                    pass
+        if res is not None and res.get('unsupported'):
+            logging.getLogger('BdPan').warning(f'{res["error"]}, running locally.')
+            res = None
+        if res is not None:
+            print(res['output'], end='')
+            if not res['ok']:
+                logging.getLogger('BdPan').error(res['error'])
+                exit(-1)
+            return
+        pan = BdPan(config)
         pan.login()
-        pan.act()
+        progress = Progress(pan.metrics) if pan.config['progress'] else None
+        if progress is not None:
+            progress.start()
+        try:
+            pan.act()
+        finally:
+            if progress is not None:
+                progress.stop()
+            pan.meta_cache.save()
+            pan.metrics.connections = pan.connection_stats()
+            for host, (requests, connections) in pan.metrics.connections.items():
+                pan.logger.info(f'{host}: {requests} requests over {connections} connections')
+            if pan.config['metrics_file']:
+                pan.metrics.dump(os.path.expanduser(pan.config['metrics_file']))
     except Exception as e:
         raise e
         exit(-1)
@@ -3,13 +3,18 @@ import json
 from argparse import RawTextHelpFormatter
 
 parser = argparse.ArgumentParser(description=' a Python client for Baidu Pan.', formatter_class=RawTextHelpFormatter)
-parser.add_argument('action', choices=['list', 'download', 'upload', 'sync', 'logout'], metavar='action',
-                    default='list', nargs='?',
-                    help='available actions: list, download, upload, sync, logout. (default: "list")\n\
+parser.add_argument('action', choices=['list', 'download', 'upload', 'sync', 'mv', 'cp', 'rm', 'daemon', 'logout'],
+                    metavar='action', default='list', nargs='?',
+                    help='available actions: list, download, upload, sync, mv, cp, rm, daemon, logout.\n\
+(default: "list")\n\
 list\t\tlist files and directories in the pan_path.\n\
 download\tdownload all files and directories in the pan_path to local_path.\n\
 upload\t\tupload all files and directories in the local_path to pan_path.\n\
 sync\t\tlocal_path and pan_path sync to each other.\n\
+mv\t\tmove pan_path to another path in Baidu Pan, given as the second path.\n\
+cp\t\tcopy pan_path to another path in Baidu Pan, given as the second path.\n\
+rm\t\tremove pan_path.\n\
+daemon\t\tkeep local_path and pan_path in sync, and run other actions for the CLI.\n\
 logout\t\tdelete all credentials.\n')
 parser.add_argument('pan_path', help='absolute path in Baidu Pan, which can be file or directory.', nargs='?')
 parser.add_argument('local_path', help='local path, which can be file or directory.', nargs='?')
@@ -26,13 +31,57 @@ overwrite\nmtime\toverwrite when a newer version of file(base on last modify tim
 parser.add_argument('-l', '--log-file', help='specify where to save log.', type=str)
 parser.add_argument('-d', '--delete-extra', action='store_true', help='delete all extra files and directories in dst_\
 path. do NOT use this option unless you know exactly what you are doing. ')
+parser.add_argument('-n', '--segments', help='the number of connections used to download a file. (default: 4)',
+                    type=int)
+parser.add_argument('--min-segment-size', help='the minimum size of a download segment in MiB. (default: 8)', type=int)
+parser.add_argument('-w', '--upload-workers', help='the number of slices of a file uploaded at the same time. \
+(default: 4)', type=int)
+parser.add_argument('--list-workers', help='the number of directories listed at the same time. (default: 4)', type=int)
+parser.add_argument('-t', '--transfer-workers', help='the number of files transferred at the same time. (default: 4)',
+                    type=int)
+parser.add_argument('--snapshot', action='store_true', help='list the whole remote tree with one recursive \
+listing, instead of listing directory by directory.')
+parser.add_argument('--dry-run', action='store_true', help='only print what sync would do, and the total size \
+of transfers.')
+parser.add_argument('--incremental', action='store_true', help='sync from the manifest of the last sync, files \
+in a directory\nwhose mtime did not change are not checked again.')
+parser.add_argument('--max-rate', help='the maximum number of metadata requests per second, a rate limit is \
+applied\nautomatically once Baidu limits the request rate. (default: unlimited)', type=float)
+parser.add_argument('--connect-timeout', help='seconds to wait for a connection. (default: 10)', type=float)
+parser.add_argument('--read-timeout', help='seconds to wait for data from a connection. (default: 60)', type=float)
+parser.add_argument('--verify', action='store_true', help='verify transferred files against the checksums of \
+Baidu Pan, and\nresume a download from its last intact block.')
+parser.add_argument('--hash-index', help='the path of the index of local file hashes. (default: \
+"~/.BdPan/hash_index.db")', type=str)
+parser.add_argument('--cache-ttl', help='seconds that remote metadata is cached for, a negative value disables \
+the cache. (default: 300)', type=int)
+parser.add_argument('--meta-cache', help='the path to save cached remote metadata between runs. (default: "", \
+only cached in memory)', type=str)
+parser.add_argument('--rehash', action='store_true', help='ignore the hash index and hash all files again.')
+parser.add_argument('--progress', action='store_true', help='print throughput and counters of transfers to \
+stderr every second.')
+parser.add_argument('--metrics-file', help='write metrics of requests and transfers to this file at exit, in the \
+Prometheus\ntext format if it ends with ".prom", otherwise in JSON.', type=str)
+parser.add_argument('--socket', help='the unix socket of the daemon, actions are run by the daemon if it is \
+running.\n(default: "~/.BdPan/daemon.sock")', type=str)
+parser.add_argument('--debounce', help='seconds without local changes before the daemon uploads them. (default: 2)',
+                    type=float)
+parser.add_argument('--poll-interval', help='seconds between syncs of the daemon to pick up remote changes. \
+(default: 300)', type=float)
 
 DEFAULT_CONFIG = {'session': "~/.BdPan/session.pkl", 'host': '127.0.0.1', 'port': 25000, 'app_id': 778750,
-                  'local_path': '.', 'pan_path': '/', "overwrite": False, 'log_file': '', "delete_extra": False}
+                  'local_path': '.', 'pan_path': '/', "overwrite": False, 'log_file': '', "delete_extra": False,
+                  'segments': 4, 'min_segment_size': 8, 'upload_workers': 4,
+                  'list_workers': 4, 'transfer_workers': 4, 'snapshot': False, 'dry_run': False,
+                  'incremental': False, 'manifest_dir': "~/.BdPan/manifests", 'max_rate': 0,
+                  'connect_timeout': 10, 'read_timeout': 60, 'verify': False,
+                  'hash_index': "~/.BdPan/hash_index.db", 'hash_index_size': 1000000, 'rehash': False,
+                  'cache_ttl': 300, 'meta_cache': '', 'progress': False, 'metrics_file': '',
+                  'socket': "~/.BdPan/daemon.sock", 'debounce': 2, 'poll_interval': 300}
 
 
 def get_config():
-    config = DEFAULT_CONFIG
+    config = dict(DEFAULT_CONFIG)  # a copy, so the defaults tell which options are given
     args = parser.parse_args()
     conf_f = {}
     try:
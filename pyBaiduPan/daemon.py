@@ -0,0 +1,318 @@
+import abc
+import ctypes
+import ctypes.util
+import io
+import json
+import os
+import select
+import signal
+import socket
+import socketserver
+import struct
+import time
+from contextlib import redirect_stdout
+from functools import partial
+from threading import Lock, Thread, current_thread, main_thread
+
+from pyBaiduPan.config import DEFAULT_CONFIG
+from pyBaiduPan.exceptions import log_error, mute_error
+
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x8, 0x80, 0x100
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x400, 0x800, 0x4000, 0x8000, 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+EVENT = struct.Struct('iIII')  # wd, mask, cookie, len of name
+
+
+class Watcher(abc.ABC):
+    # changes(timeout, debounce) blocks until something under root changed or timeout, then collects further
+    # changes until none came for debounce seconds, and returns the changed paths as one batch.
+    def __init__(self, root):
+        self.root = root
+
+    @abc.abstractmethod
+    def read(self, timeout):  # return the paths changed within timeout seconds
+        pass
+
+    def changes(self, timeout, debounce):
+        changed = self.read(timeout)
+        deadline = time.monotonic() + debounce * 10  # a file written all the time must not hold back the others
+        while changed and time.monotonic() < deadline:
+            more = self.read(min(debounce, deadline - time.monotonic()))
+            if not more:
+                break
+            changed |= more
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(Watcher):
+    def __init__(self, root):
+        super().__init__(root)
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {}  # wd: directory
+        self._watch_tree(root)
+
+    def _watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self.dirs[wd] = path
+
+    def _watch_tree(self, path):
+        # files created before the watch of a new directory is added are reported by walking it.
+        found = set()
+        for root, dirs, files in os.walk(path):
+            self._watch(root)
+            found.add(root)
+            found.update(os.path.join(root, x) for x in files)
+        return found
+
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return set()
+        data, changed, i = os.read(self.fd, 1 << 16), set(), 0
+        while i < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, i)
+            name = data[i + EVENT.size:i + EVENT.size + length].rstrip(b'\0')
+            i += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:  # events are lost, everything may have changed
+                changed |= self._watch_tree(self.root)
+            elif mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+            elif wd in self.dirs and name:
+                path = os.path.join(self.dirs[wd], os.fsdecode(name))
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        changed |= self._watch_tree(path)
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher(Watcher):
+    # for systems without inotify, the tree is scanned every interval seconds.
+    def __init__(self, root, interval=5):
+        super().__init__(root)
+        self.interval = interval
+        self.state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for root, dirs, files in os.walk(self.root):
+            state[root] = None
+            for x in files:
+                try:
+                    st = os.stat(os.path.join(root, x))
+                except FileNotFoundError:
+                    continue
+                state[os.path.join(root, x)] = (st.st_mtime_ns, st.st_size)
+        return state
+
+    def read(self, timeout):
+        end = time.monotonic() + max(timeout, 0)
+        while True:
+            time.sleep(max(min(self.interval, end - time.monotonic()), 0))
+            state = self._scan()
+            changed = {k for k, v in state.items() if self.state.get(k, False) != v}
+            self.state = state
+            if changed or time.monotonic() >= end:
+                return changed
+
+
+def new_watcher(root, interval=5):
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError, TypeError):  # not Linux, or no inotify in libc
+        return PollWatcher(root, interval)
+
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        self.wfile.write(json.dumps(self.server.daemon.command(request)).encode('utf-8') + b'\n')
+
+
+if hasattr(socket, 'AF_UNIX'):  # not on Windows, where the daemon runs without taking commands
+    class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class Daemon:
+    # keeps one logged in BdPan, so its session, connection pools and caches stay warm. local changes are uploaded
+    # in batches, remote changes are picked up by a sync every poll_interval seconds, and CLI commands are run
+    # through a unix socket.
+    COMMANDS = ('list', 'download', 'upload', 'sync', 'mv', 'cp', 'rm')
+    # options applied to each command, the others must be the same as those of the daemon
+    COMMAND_KEYS = ('pan_path', 'local_path', 'overwrite', 'delete_extra', 'dry_run', 'incremental', 'snapshot',
+                    'verify', 'rehash', 'segments', 'min_segment_size', 'upload_workers', 'list_workers',
+                    'transfer_workers')
+    CLIENT_KEYS = ('action', 'conf', 'socket', 'debounce', 'poll_interval')  # not options of a command
+
+    def __init__(self, pan):
+        self.pan, c = pan, pan.config
+        self.local_path, self.pan_path = os.path.abspath(c['local_path']), c['pan_path']
+        self.overwrite = 'force' if c['overwrite'] == 'force' else 'mtime'  # local changes are newer
+        self.lock = Lock()  # one sync, batch or command at a time
+        self.synced = {}  # local path: mtime_ns of files written by syncs, which are not uploaded again
+        self.socket_file = os.path.expanduser(c['socket'])
+        self.watcher = self.server = None
+
+    def run(self):
+        os.makedirs(self.local_path, exist_ok=True)
+        if current_thread() is main_thread():
+            signal.signal(signal.SIGTERM, lambda *args: exit(0))  # so the socket is removed
+        self.watcher = new_watcher(self.local_path)
+        if hasattr(socket, 'AF_UNIX'):
+            self._serve()
+        else:
+            self.pan.logger.warning('daemon: unix sockets are not supported, actions of the CLI run without it.')
+        try:
+            self.sync()
+            next_poll = time.monotonic() + self.pan.config['poll_interval']
+            while True:
+                changed = self.watcher.changes(next_poll - time.monotonic(), self.pan.config['debounce'])
+                if changed:
+                    self.upload(changed)
+                if time.monotonic() >= next_poll:
+                    self.sync()
+                    next_poll = time.monotonic() + self.pan.config['poll_interval']
+        finally:
+            self.close()
+
+    def _serve(self):
+        os.makedirs(os.path.dirname(self.socket_file), exist_ok=True)
+        if os.path.exists(self.socket_file):
+            try:
+                send(self.socket_file, {'action': 'ping'}, 5)
+            except OSError:
+                os.remove(self.socket_file)  # left by a daemon that did not exit cleanly
+            else:
+                raise RuntimeError(f'daemon: another daemon is listening on {self.socket_file}.')
+        umask = os.umask(0o077)  # only the owner may use the session through the socket
+        try:
+            self.server = CommandServer(self.socket_file, CommandHandler)
+        finally:
+            os.umask(umask)
+        self.server.daemon = self
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pan.logger.info(f'daemon: watching {self.local_path}, listening on {self.socket_file}')
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            os.remove(self.socket_file)
+        if self.watcher is not None:
+            self.watcher.close()
+
+    @mute_error  # failed transfers are logged, and tried again by the next sync
+    @log_error
+    def sync(self):
+        with self.lock:
+            plan = self.pan.sync(self.pan_path, self.local_path, self.overwrite, False)
+            for rel, l, r in plan.ops['download'] if plan is not None else ():
+                path = plan.local(rel)
+                self.synced[path] = os.stat(path).st_mtime_ns
+
+    @mute_error
+    @log_error
+    def upload(self, paths):
+        # one batch: metadata of the remote paths is fetched by one listing per directory, then files are
+        # uploaded concurrently by one engine.
+        with self.lock:  # a download running in a sync or command has finished, or left both its .part files
+            files, dirs = [], []
+            for path in sorted(paths):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:  # removed again before the batch started
+                    continue
+                if os.path.isdir(path):
+                    if path != self.local_path and not self._known_dir(self._remote(path)):
+                        dirs.append(path)
+                elif self.synced.get(path) != st.st_mtime_ns and not self._partial(path):
+                    files.append(path)
+            if not files and not dirs:
+                return
+            self.pan.logger.info(f'daemon: {len(files)} files and {len(dirs)} directories changed')
+            for path in dirs:
+                self.pan.makedir(self._remote(path))
+            engine = self.pan._engine()
+            for path, meta in zip(files, self.pan.metas([self._remote(x) for x in files])):
+                engine.transfer(partial(self.pan.upload_file, self._remote(path), path, self.overwrite, meta))
+            engine.wait()
+            for path in files:
+                self.synced.pop(path, None)
+
+    @staticmethod
+    def _partial(path):
+        # f.part and f.part.seg are written by a download of f, and always exist together until it is done.
+        # user files with these suffixes are uploaded as usual.
+        if path.endswith('.part'):
+            return os.path.exists(path + '.seg')
+        return path.endswith('.part.seg') and os.path.exists(path[:-len('.seg')])
+
+    def _known_dir(self, bd_path):
+        hit, meta = self.pan.meta_cache.get_meta(bd_path)
+        return hit and meta is not None and meta['isdir'] == 1
+
+    def _remote(self, path):
+        rel = os.path.relpath(path, self.local_path).replace(os.sep, '/')
+        return self.pan_path.rstrip('/') + '/' + rel if rel != '.' else self.pan_path
+
+    def command(self, request):
+        action = request.get('action')
+        if action == 'ping':
+            return {'ok': True, 'output': ''}
+        if action not in Daemon.COMMANDS:
+            return {'ok': False, 'output': '', 'error': f'unsupported action: {action}'}
+        out, config = io.StringIO(), self.pan.config
+        own = json.loads(json.dumps({k: config.get(k) for k in request.get('options', {})}))
+        unsupported = sorted(k for k, v in request.get('options', {}).items() if own[k] != v)
+        if unsupported:  # e.g. another account, a metrics file or a rate limit, the client runs it itself
+            return {'ok': False, 'output': '', 'unsupported': unsupported,
+                    'error': f'the daemon does not run with {", ".join(unsupported)}'}
+        with self.lock:
+            saved = {k: config[k] for k in Daemon.COMMAND_KEYS if k in config}
+            config.update({k: v for k, v in request.items() if k in Daemon.COMMAND_KEYS})
+            try:
+                with redirect_stdout(out):
+                    getattr(self.pan, action)()
+            except Exception as e:
+                return {'ok': False, 'output': out.getvalue(), 'error': f'{type(e).__name__}: {e}'}
+            finally:
+                config.update(saved)
+        return {'ok': True, 'output': out.getvalue()}
+
+
+def send(socket_file, request, timeout=None):
+    # run a command in the daemon, raise OSError if no daemon is listening.
+    if not hasattr(socket, 'AF_UNIX'):
+        raise OSError('unix sockets are not supported')
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.settimeout(timeout)
+        s.connect(socket_file)
+        s.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with s.makefile('rb') as f:
+            return json.loads(f.readline())
+
+
+def request_from(config):
+    # local paths are made absolute, since the daemon runs in another directory. other options given to the
+    # client are sent as well, so the daemon can refuse commands it would run differently.
+    request = {k: config[k] for k in ('action',) + Daemon.COMMAND_KEYS if k in config}
+    request['options'] = {k: v for k, v in config.items() if k not in Daemon.COMMAND_KEYS + Daemon.CLIENT_KEYS
+                          and v != DEFAULT_CONFIG.get(k)}
+    if config['action'] in ('download', 'upload', 'sync') and config.get('local_path'):
+        request['local_path'] = os.path.abspath(config['local_path'])
+    return request
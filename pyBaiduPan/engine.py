@@ -0,0 +1,69 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Semaphore
+
+
+class TransferEngine:
+    # listing tasks discover the tree ahead, while transfer tasks move files in a separate pool.
+    def __init__(self, list_workers=4, transfer_workers=4):
+        self.list_pool = ThreadPoolExecutor(list_workers)
+        self.transfer_pool = ThreadPoolExecutor(transfer_workers)
+        self.queued = Semaphore(transfer_workers * 4)  # transfers waiting, so listing never runs too far ahead
+        self.cond = Condition()
+        self.pending = 0
+        self.error = None
+
+    def _submit(self, pool, func, then=None, slot=None):
+        with self.cond:
+            if self.error is not None:
+                return
+            self.pending += 1
+        if slot is not None:
+            slot.acquire()
+        pool.submit(self._run, func, then, slot)
+
+    def _run(self, func, then, slot=None):
+        try:
+            if self.error is None:
+                func()
+                if then is not None:
+                    then()
+        except Exception as e:
+            with self.cond:
+                self.error = self.error or e
+        finally:
+            if slot is not None:
+                slot.release()
+            with self.cond:
+                self.pending -= 1
+                self.cond.notify_all()
+
+    def list(self, func):
+        self._submit(self.list_pool, func)
+
+    def transfer(self, func, then=None):
+        self._submit(self.transfer_pool, func, then, self.queued)
+
+    def transfer_all(self, funcs, then=None):
+        # then is called once all funcs are done, and never if one of them failed.
+        lock, left = Lock(), [1]  # one for the loop below, so then is not called before all funcs are submitted
+
+        def done():
+            with lock:
+                left[0] -= 1
+                if left[0] or then is None:
+                    return
+            then()
+
+        for func in funcs:
+            with lock:
+                left[0] += 1
+            self.transfer(func, done)
+        done()
+
+    def wait(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending == 0)
+        self.list_pool.shutdown()
+        self.transfer_pool.shutdown()
+        if self.error is not None:
+            raise self.error
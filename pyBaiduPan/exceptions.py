@@ -1,5 +1,8 @@
 class BdApiError(IOError):
-    pass
+    def __init__(self, *args, errno=None, status=None):
+        super().__init__(*args)
+        self.errno = errno  # errno or error_code returned by Baidu
+        self.status = status  # http status code
 
 
 def mute_error(func):
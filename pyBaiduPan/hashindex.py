@@ -0,0 +1,57 @@
+import json
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+class HashIndex:
+    EVICT_RATIO = 0.9
+
+    def __init__(self, db_file, max_size=1000000):
+        os.makedirs(os.path.split(db_file)[0], exist_ok=True)
+        self.max_size = max_size
+        self.lock = Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS hash (path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, '
+                        'mtime INTEGER, content_md5 TEXT, slice_md5 TEXT, block_list TEXT, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS hash_used ON hash (used)')
+        self.size = self.db.execute('SELECT COUNT(*) FROM hash').fetchone()[0]
+
+    @staticmethod
+    def key(path):
+        st = os.stat(path)
+        return os.path.abspath(path), st.st_ino, st.st_size, st.st_mtime_ns
+
+    def get(self, path):  # an entry is invalid once inode, size or mtime of the file changed
+        path, inode, size, mtime = self.key(path)
+        with self.lock, self.db:
+            row = self.db.execute('SELECT inode, size, mtime, content_md5, slice_md5, block_list FROM hash '
+                                  'WHERE path=?', (path,)).fetchone()
+            if row is None:
+                return
+            if row[:3] != (inode, size, mtime):
+                self.db.execute('DELETE FROM hash WHERE path=?', (path,))
+                self.size -= 1
+                return
+            self.db.execute('UPDATE hash SET used=? WHERE path=?', (time.time(), path))
+        return row[3], row[4], json.loads(row[5])
+
+    def put(self, key, content_md5, slice_md5, block_list):
+        # key is taken before the file is hashed, so hashes of a file changed meanwhile are not saved as new.
+        path, inode, size, mtime = key
+        with self.lock, self.db:
+            exists = self.db.execute('SELECT 1 FROM hash WHERE path=?', (path,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO hash VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (path, inode, size, mtime, content_md5, slice_md5, json.dumps(block_list), time.time()))
+            self.size += exists is None
+            if self.size > self.max_size:  # evict least recently used entries
+                n = self.size - int(self.max_size * HashIndex.EVICT_RATIO)
+                self.db.execute('DELETE FROM hash WHERE path IN (SELECT path FROM hash ORDER BY used LIMIT ?)', (n,))
+                self.size -= n
+
+    def close(self):
+        with self.lock:
+            self.db.close()
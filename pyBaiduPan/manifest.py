@@ -0,0 +1,27 @@
+import json
+import os
+from hashlib import md5
+
+
+class Manifest:
+    # the state of the last successful sync between a pan_path and a local_path.
+    def __init__(self, manifest_dir, pan_path, local_path):
+        key = md5(f'{pan_path.rstrip("/") or "/"}\n{os.path.abspath(local_path)}'.encode('utf-8')).hexdigest()
+        self.file = os.path.join(manifest_dir, key + '.json')
+        self.files = {}  # relative path: {'size', 'mtime', 'md5', 'fs_id'}
+        self.dirs = {}  # relative path of local directory: mtime in ns
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.file) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        self.files, self.dirs = data['files'], data['dirs']
+
+    def save(self):
+        os.makedirs(os.path.split(self.file)[0], exist_ok=True)
+        with open(self.file + '.tmp', 'w') as f:
+            json.dump({'files': self.files, 'dirs': self.dirs}, f)
+        os.replace(self.file + '.tmp', self.file)
@@ -0,0 +1,104 @@
+import os
+import pickle
+import posixpath
+import time
+from threading import Lock
+
+
+class MetaCache:
+    def __init__(self, ttl=300, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.lock = Lock()
+        self.metas = {}  # path: (expire time, meta)
+        self.lists = {}  # dir: (expire time, {path: meta})
+        self._load()
+
+    @staticmethod
+    def _norm(path):
+        return path.rstrip('/') or '/'
+
+    @staticmethod
+    def _valid(entry):
+        return entry is not None and time.time() < entry[0]
+
+    def get_meta(self, path):
+        # return (True, meta) on a hit, meta is None if the path is known to be missing.
+        path = self._norm(path)
+        with self.lock:
+            entry = self.metas.get(path)
+            if self._valid(entry):
+                return True, entry[1]
+            entry = self.lists.get(posixpath.split(path)[0])
+            if self._valid(entry):
+                return True, entry[1].get(path)
+        return False, None
+
+    def get_list(self, path):
+        with self.lock:
+            entry = self.lists.get(self._norm(path))
+            if self._valid(entry):
+                return list(entry[1].values())
+
+    def put_meta(self, meta, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        path, expire = self._norm(meta['path']), time.time() + ttl
+        with self.lock:
+            self.metas[path] = (expire, meta)
+            entry = self.lists.get(posixpath.split(path)[0])
+            if entry is not None:
+                entry[1][path] = meta
+
+    def put_list(self, path, ls, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        expire = time.time() + ttl
+        with self.lock:
+            self.lists[self._norm(path)] = (expire, {self._norm(x['path']): x for x in ls})
+            for x in ls:
+                self.metas[self._norm(x['path'])] = (expire, x)
+
+    def remove(self, *paths):
+        with self.lock:
+            for path in map(self._norm, paths):
+                prefix = path.rstrip('/') + '/'
+                for d in (self.metas, self.lists):
+                    for k in [k for k in d if k == path or k.startswith(prefix)]:
+                        del d[k]
+                entry = self.lists.get(posixpath.split(path)[0])
+                if entry is not None:
+                    entry[1].pop(path, None)
+
+    def invalidate(self, *paths):
+        # forget paths and the listings of their parents, e.g. when a path is created by a move.
+        self.remove(*paths)
+        with self.lock:
+            for path in map(self._norm, paths):
+                self.lists.pop(posixpath.split(path)[0], None)
+
+    def clear(self):
+        with self.lock:
+            self.metas.clear()
+            self.lists.clear()
+
+    def _load(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, 'rb') as f:
+                self.metas, self.lists = pickle.load(f)
+        except Exception:
+            return
+        for d in (self.metas, self.lists):
+            for k in [k for k, v in d.items() if not self._valid(v)]:
+                del d[k]
+
+    def save(self):
+        if not self.cache_file:
+            return
+        os.makedirs(os.path.split(self.cache_file)[0], exist_ok=True)
+        with self.lock, open(self.cache_file, 'wb') as f:
+            pickle.dump((self.metas, self.lists), f)
@@ -0,0 +1,122 @@
+import json
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from threading import Event, Lock, Thread
+
+from pyBaiduPan.utils import sizeof_fmt
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.start = time.time()
+        self.requests = {}  # "api method": {'count', 'errors', 'seconds', 'max_seconds'}
+        self.errnos = Counter()  # errno of failed requests: count
+        self.retries = Counter()  # what is retried: count
+        self.bytes = Counter()  # download, upload or hash: bytes
+        self.files = Counter()  # download, upload or rapid_upload: files
+        self.phases = Counter()  # list, hash, download or upload: seconds, summed over workers
+        self.connections = {}  # host: (requests, connections), set at the end of a run
+
+    def request(self, api, method, seconds, errno=None, error=False):
+        with self.lock:
+            x = self.requests.setdefault(f'{api} {method}', {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                                              'max_seconds': 0.0})
+            x['count'] += 1
+            x['errors'] += error
+            x['seconds'] += seconds
+            x['max_seconds'] = max(x['max_seconds'], seconds)
+            if errno is not None:
+                self.errnos[errno] += 1
+
+    def retry(self, what):
+        with self.lock:
+            self.retries[what] += 1
+
+    def add_bytes(self, kind, n):
+        with self.lock:
+            self.bytes[kind] += n
+
+    def add_file(self, kind):
+        with self.lock:
+            self.files[kind] += 1
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] += time.perf_counter() - start
+
+    def summary(self):
+        with self.lock:
+            return {'seconds': time.time() - self.start, 'requests': {k: dict(v) for k, v in self.requests.items()},
+                    'errnos': {str(k): v for k, v in self.errnos.items()}, 'retries': dict(self.retries),
+                    'bytes': dict(self.bytes), 'files': dict(self.files), 'phases': dict(self.phases),
+                    'connections': {k: {'requests': r, 'connections': c} for k, (r, c) in self.connections.items()}}
+
+    def prometheus(self):
+        s, lines = self.summary(), []
+
+        def metric(name, kind, help_, samples):
+            lines.extend([f'# HELP bdpan_{name} {help_}', f'# TYPE bdpan_{name} {kind}'])
+            lines.extend(f'bdpan_{name}{labels} {value}' for labels, value in samples)
+
+        def label(**kwargs):
+            return '{' + ','.join(f'{k}="{v}"' for k, v in kwargs.items()) + '}'
+
+        metric('run_seconds', 'gauge', 'duration of the run.', [('', s['seconds'])])
+        for key, name, kind, help_ in (('count', 'requests_total', 'counter', 'requests sent.'),
+                                       ('errors', 'request_errors_total', 'counter', 'failed requests.'),
+                                       ('seconds', 'request_seconds_total', 'counter', 'total latency of requests.'),
+                                       ('max_seconds', 'request_max_seconds', 'gauge', 'max latency of a request.')):
+            metric(name, kind, help_,
+                   [(label(api=k.split()[0], method=k.split()[1]), v[key]) for k, v in s['requests'].items()])
+        metric('errno_total', 'counter', 'failed requests by Baidu errno.',
+               [(label(errno=k), v) for k, v in s['errnos'].items()])
+        metric('retries_total', 'counter', 'retried requests.', [(label(what=k), v) for k, v in s['retries'].items()])
+        metric('bytes_total', 'counter', 'bytes transferred or hashed.', [(label(kind=k), v)
+                                                                         for k, v in s['bytes'].items()])
+        metric('files_total', 'counter', 'files transferred.', [(label(kind=k), v) for k, v in s['files'].items()])
+        metric('phase_seconds', 'counter', 'seconds spent in each phase, summed over workers.',
+               [(label(phase=k), v) for k, v in s['phases'].items()])
+        metric('host_requests_total', 'counter', 'requests sent to each host.',
+               [(label(host=k), v['requests']) for k, v in s['connections'].items()])
+        metric('host_connections_total', 'counter', 'connections opened to each host.',
+               [(label(host=k), v['connections']) for k, v in s['connections'].items()])
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            if path.endswith('.prom'):
+                f.write(self.prometheus())
+            else:
+                json.dump(self.summary(), f, indent=2)
+
+
+class Progress(Thread):
+    # print throughput and counters to stderr until stopped.
+    def __init__(self, metrics, interval=1.0, out=sys.stderr):
+        super().__init__(daemon=True)
+        self.metrics, self.interval, self.out = metrics, interval, out
+        self.stopped = Event()
+
+    def run(self):
+        last, last_time = Counter(), time.time()
+        while not self.stopped.wait(self.interval):
+            s, now = self.metrics.summary(), time.time()
+            rate = {k: (s['bytes'].get(k, 0) - last[k]) / (now - last_time) for k in ('download', 'upload', 'hash')}
+            last, last_time = Counter(s['bytes']), now
+            self.out.write('\r' + '  '.join(f'{k} {sizeof_fmt(v)}/s' for k, v in rate.items()) +
+                           f"  files {sum(s['files'].values())}  requests "
+                           f"{sum(x['count'] for x in s['requests'].values())}  retries {sum(s['retries'].values())} ")
+            self.out.flush()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.out.write('\n')
@@ -0,0 +1,83 @@
+import os
+import posixpath
+
+OPS = ('mkdir_local', 'mkdir_remote', 'download', 'upload', 'skip', 'conflict')
+
+
+class SyncPlan:
+    def __init__(self, local_path, pan_path, root_exists=False):
+        self.local_path = local_path
+        self.pan_path = pan_path
+        self.root_exists = root_exists  # whether pan_path exists already
+        self.ops = {op: [] for op in OPS}  # op: [(relative path, local info, remote meta)]
+
+    def add(self, op, rel, local, remote):
+        self.ops[op].append((rel, local, remote))
+
+    def local(self, rel):
+        return os.path.join(self.local_path, *rel.split('/'))
+
+    def remote(self, rel):
+        return posixpath.join(self.pan_path, rel)
+
+    def size(self, op):
+        key = {'download': lambda x: x[2]['size'], 'upload': lambda x: x[1]['size']}.get(op)
+        return sum(map(key, self.ops[op])) if key else 0
+
+    def summary(self):
+        return {op: (len(self.ops[op]), self.size(op)) for op in OPS}
+
+
+def scan_local(path, manifest=None):
+    # relative path: {'isdir', 'size', 'mtime'}, classified the same way as upload does.
+    # files in a directory whose mtime is unchanged since the manifest was saved are not stat again.
+    ret, dirs_mtime = {}, {}
+    for root, dirs, files in os.walk(path):
+        r_path = os.path.relpath(root, path)
+        r_path = '' if r_path == '.' else r_path.replace(os.sep, '/')
+        dirs_mtime[r_path] = os.stat(root).st_mtime_ns
+        rels = [posixpath.join(r_path, name) for name in files]
+        known = manifest is not None and manifest.dirs.get(r_path) == dirs_mtime[r_path] and all(
+            x in manifest.files for x in rels)
+        for name, rel in zip(files, rels):
+            if known:
+                ret[rel] = {'isdir': 0, 'size': manifest.files[rel]['size'], 'mtime': manifest.files[rel]['mtime']}
+            else:
+                st = os.stat(os.path.join(root, name))
+                ret[rel] = {'isdir': 0, 'size': st.st_size, 'mtime': round(st.st_mtime)}
+        for name in dirs:
+            ret[posixpath.join(r_path, name)] = {'isdir': 1, 'size': 0, 'mtime': 0}
+    return ret, dirs_mtime
+
+
+def scan_remote(snapshot):
+    # relative path: meta
+    root = snapshot.root.rstrip('/') + '/'
+    return {x['path'][len(root):]: x for x in snapshot}
+
+
+def plan(local_path, pan_path, local, remote, overwrite='none', root_exists=False):
+    # one pass over both sides. a file present on both sides is transferred according to overwrite:
+    # none keeps both and reports a conflict if they differ, mtime keeps the newer one, force keeps the remote one.
+    ret = SyncPlan(local_path, pan_path, root_exists)
+    for rel in sorted(set(local) | set(remote)):
+        l, r = local.get(rel), remote.get(rel)
+        if l is not None and r is not None and l['isdir'] != r['isdir']:
+            ret.add('conflict', rel, l, r)
+        elif l is not None and l['isdir']:
+            ret.add('mkdir_remote' if r is None else 'skip', rel, l, r)
+        elif r is not None and r['isdir']:
+            ret.add('mkdir_local', rel, l, r)
+        elif r is None:
+            ret.add('upload', rel, l, r)
+        elif l is None:
+            ret.add('download', rel, l, r)
+        elif overwrite == 'force':
+            ret.add('download', rel, l, r)
+        elif overwrite == 'mtime' and l['mtime'] != r['local_mtime']:
+            ret.add('upload' if l['mtime'] > r['local_mtime'] else 'download', rel, l, r)
+        elif overwrite == 'none' and (l['size'] != r['size'] or l['mtime'] != r['local_mtime']):
+            ret.add('conflict', rel, l, r)
+        else:
+            ret.add('skip', rel, l, r)
+    return ret
@@ -0,0 +1,68 @@
+import random
+import time
+from threading import Lock
+
+from pyBaiduPan.exceptions import BdApiError
+
+RETRY, THROTTLE, FATAL = 'retry', 'throttle', 'fatal'
+THROTTLE_ERRNO = {31034, 42000}  # hit frequency limit
+FATAL_ERRNO = {-6, -7, -8, -9, 2, 6, 31023, 31061, 31062, 31064, 31066}  # auth, params, exists, not exist, ...
+
+
+def classify(e):
+    if isinstance(e, BdApiError):
+        if e.errno in THROTTLE_ERRNO or e.status == 429:
+            return THROTTLE
+        if e.errno in FATAL_ERRNO or (e.status is not None and 400 <= e.status < 500 and e.status != 408):
+            return FATAL
+    return RETRY  # connection errors, timeouts, 5xx and broken responses
+
+
+def backoff(attempt, base=1.0, cap=60.0):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter:
+    # a token bucket shared by all workers. without max_rate, requests are not limited until Baidu throttles us.
+    # the rate is halved whenever Baidu throttles us, and grows back a little with every successful request,
+    # until it is unlimited again.
+    THROTTLED_RATE = 20.0  # where the rate starts from when an unlimited bucket is throttled
+
+    def __init__(self, max_rate=0, min_rate=0.5, step=0.1):
+        self.max_rate, self.min_rate, self.step = max_rate, min_rate, step
+        self.rate = max_rate or None  # None for unlimited
+        self.tokens = max_rate
+        self.last = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                if self.rate is None:
+                    return
+                now = time.monotonic()
+                self.tokens = min(max(self.rate, 1), self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate is None:
+                return
+            self.rate += self.step
+            if self.max_rate:
+                self.rate = min(self.max_rate, self.rate)
+            elif self.rate >= RateLimiter.THROTTLED_RATE:
+                self.rate = None
+
+    def throttled(self):
+        with self.lock:
+            if self.rate is None:
+                self.rate, self.tokens, self.last = RateLimiter.THROTTLED_RATE, 0, time.monotonic()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
@@ -0,0 +1,38 @@
+import posixpath
+
+
+class Snapshot:
+    # an index by path of a whole remote subtree, built from one recursive listing.
+    def __init__(self, root, metas=()):
+        self.root = self._norm(root)
+        self.metas = {}
+        self.children = {self.root: []}
+        for x in metas:
+            self.add(x)
+
+    @staticmethod
+    def _norm(path):
+        return path.rstrip('/') or '/'
+
+    def add(self, meta):
+        path = self._norm(meta['path'])
+        self.metas[path] = meta
+        self.children.setdefault(posixpath.split(path)[0], []).append(meta)
+        if meta['isdir']:
+            self.children.setdefault(path, [])
+
+    def get(self, path):
+        return self.metas.get(self._norm(path))
+
+    def list(self, path):
+        return self.children.get(self._norm(path), [])
+
+    def __contains__(self, path):
+        path = self._norm(path)
+        return path == self.root or path.startswith(self.root.rstrip('/') + '/')
+
+    def __len__(self):
+        return len(self.metas)
+
+    def __iter__(self):
+        return iter(self.metas.values())
@@ -0,0 +1,6 @@
+def sizeof_fmt(num):
+    for unit in ['B', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s" % (num, unit)
+        num /= 1024.0
+    return "%.1f%s" % (num, 'Y')